@@ -1,71 +1,220 @@
 import streamlit as st
 import geopandas as gpd
 import ezdxf
-import fiona
-import osmnx as ox
+import pyogrio
 import tempfile
+import io
+import re
+import shutil
 import os
+from concurrent.futures import ThreadPoolExecutor
 import folium
+from folium.plugins import FastMarkerCluster
+from streamlit_folium import folium_static
 import pandas as pd
-from shapely.geometry import Point, LineString, MultiLineString
+import numpy as np
+import shapely
 from shapely.ops import unary_union
 
 # --- 1. CONFIGURATION & LAYER PROPERTIES ---
 st.set_page_config(page_title="KML to CAD Pro: Seamless Road Edition", layout="wide")
 
-def get_layer_info(name):
-    """Menentukan warna layer sesuai standar teknis gambar referensi."""
-    name = str(name).upper()
-    if any(k in name for k in ['TE', 'POLE', 'TIANG']):
-        return 'TIANG_POLE', 2  # Kuning
-    if any(k in name for k in ['ODC', 'ODP', 'BOX', 'FDT']):
-        return 'DEVICE_RED', 1  # Merah
-    if any(k in name for k in ['KABEL', 'FO', 'CABLE']):
-        return 'CABLE_MAIN', 3  # Hijau
-    return 'OBJEK_LAIN', 7 # Putih
+# Pembacaan kolumnar via Arrow butuh GDAL >= 3.6 dan pyarrow; selain itu pakai jalur biasa
+try:
+    import pyarrow  # noqa: F401
+    USE_ARROW = pyogrio.__gdal_version__ >= (3, 6, 0)
+except ImportError:
+    USE_ARROW = False
+
+# Aturan layer berurutan prioritas: (kata kunci pada nama, nama layer, warna ACI)
+LAYER_RULES = [
+    (['TE', 'POLE', 'TIANG'], 'TIANG_POLE', 2),      # Kuning
+    (['ODC', 'ODP', 'BOX', 'FDT'], 'DEVICE_RED', 1), # Merah
+    (['KABEL', 'FO', 'CABLE'], 'CABLE_MAIN', 3),     # Hijau
+]
+DEFAULT_LAYER = ('OBJEK_LAIN', 7) # Putih
+# Layer tetap di setiap DXF (jalan, label, offset kabel): nama -> warna ACI
+DXF_LAYERS = {
+    'MAP_ROAD_OUTLINE': 7, # Putih
+    'LABEL_INFO': 7,
+    'CABLE_OFFSET': 1,     # Merah
+}
+# Satu regex per aturan, dikompilasi sekali saat modul dimuat
+LAYER_PATTERNS = [re.compile('|'.join(map(re.escape, keys))) for keys, _, _ in LAYER_RULES]
+
+# Jarak (meter) di luar batas data KML yang jalannya tetap digambar di DXF
+ROAD_CLIP_MARGIN = 50
+
+# Di atas jumlah tiang ini preview memakai FastMarkerCluster, bukan satu marker per tiang
+PREVIEW_CLUSTER_MIN = 2000
+
+# Toleransi default (meter) penyederhanaan vertex kabel sebelum ditulis ke DXF; 0 = tanpa penyederhanaan
+SIMPLIFY_TOLERANCE = 0.1
+
+# Kode tipe geometri GEOS (shapely.get_type_id) untuk seleksi cepat tanpa membandingkan string
+POINT, LINESTRING = int(shapely.GeometryType.POINT), int(shapely.GeometryType.LINESTRING)
+
+def classify_layers(names):
+    """Menentukan layer & warna seluruh objek sekaligus sesuai standar teknis gambar referensi."""
+    upper = pd.Series(names, dtype=object).astype(str).str.upper()
+    masks = [upper.str.contains(pattern).values for pattern in LAYER_PATTERNS]
+    layer_names = np.select(masks, [ln for _, ln, _ in LAYER_RULES], default=DEFAULT_LAYER[0])
+    colors = np.select(masks, [color for _, _, color in LAYER_RULES], default=DEFAULT_LAYER[1])
+    return layer_names, colors
 
 # --- 2. CORE GEOSPATIAL PROCESSING ---
+def read_kml_layer(path, layer):
+    """Membaca satu layer KML (hanya Point & LineString); None jika kosong atau gagal dibaca."""
+    try:
+        # Hanya kolom Name yang dipakai (label & klasifikasi layer); atribut lain tidak dibaca
+        tmp_gdf = gpd.read_file(path, layer=layer, engine='pyogrio', use_arrow=USE_ARROW, columns=['Name'])
+    except: return None
+    # Filter Point/LineString per layer agar concat tidak menyalin objek yang akan dibuang
+    type_ids = shapely.get_type_id(tmp_gdf.geometry.values)
+    tmp_gdf = tmp_gdf[(type_ids == POINT) | (type_ids == LINESTRING)]
+    return None if tmp_gdf.empty else tmp_gdf
+
 def load_and_project_kml(path):
-    """Membaca KML dan memproyeksikan ke UTM (Meter) untuk akurasi tinggi."""
-    layers = fiona.listlayers(path)
-    gdfs = []
-    for layer in layers:
-        try:
-            tmp_gdf = gpd.read_file(path, layer=layer, driver='KML')
-            if not tmp_gdf.empty:
-                gdfs.append(tmp_gdf)
-        except: continue
+    """Membaca KML dan memproyeksikan ke UTM (Meter) untuk akurasi tinggi.
+
+    Mengembalikan (gdf_utm, gdf_latlon); data lat/lon asli ikut dikembalikan
+    agar preview & query OSM tidak perlu memproyeksikan balik dari UTM.
+    """
+    # Satu kali baca daftar layer, lalu tiap layer dibaca lewat engine pyogrio (tanpa Fiona).
+    # Filter ini best-effort: hanya driver KML biasa yang melaporkan tipe geometri per layer,
+    # sehingga layer non-spasial/poligon dilewati tanpa dibuka. LIBKML melaporkan semua layer
+    # sebagai 'Unknown', jadi di sana tidak ada yang tersaring; layer kosong atau poligon
+    # baru dibuang oleh read_kml_layer setelah dibaca (cek jumlah fitur lebih awal berarti
+    # parse ulang seluruh dokumen per layer).
+    layers = [name for name, geom_type in pyogrio.list_layers(path)
+              if geom_type is not None and 'Polygon' not in geom_type]
+    # Layer dibaca berurutan: LIBKML mem-parse ulang seluruh dokumen di setiap open,
+    # sehingga thread paralel hanya melipatgandakan memori tanpa mempercepat baca
+    gdfs = [g for g in (read_kml_layer(path, layer) for layer in layers) if g is not None]
     
-    if not gdfs: return None
+    if not gdfs: return None, None
     
     full_gdf = pd.concat(gdfs, ignore_index=True)
-    full_gdf = full_gdf[full_gdf.geometry.type.isin(['Point', 'LineString'])]
+    del gdfs # Lepas frame per layer sebelum proyeksi
     
     # Proyeksi ke Meter agar lebar jalan tetap konsisten (misal 3.5m)
     utm_gdf = full_gdf.to_crs(full_gdf.estimate_utm_crs())
-    utm_gdf['Length_M'] = utm_gdf.apply(
-        lambda row: round(row.geometry.length, 1) if row.geometry.geom_type == 'LineString' else 0, axis=1
-    )
-    return utm_gdf
+    # Panjang dihitung sekaligus di GEOS; objek selain LineString bernilai 0
+    geoms = utm_gdf.geometry.values
+    is_line = shapely.get_type_id(geoms) == LINESTRING
+    utm_gdf['Length_M'] = np.where(is_line, np.round(shapely.length(geoms), 1), 0)
+    # Nama dinormalisasi sekali (kosong jika tidak ada); layer & warna CAD disimpan
+    # sebagai kolom agar ikut ter-cache bersama hasil load
+    names = utm_gdf['Name'] if 'Name' in utm_gdf else pd.Series('', index=utm_gdf.index)
+    utm_gdf['Name'] = names.fillna('').astype(str)
+    utm_gdf['Layer'], utm_gdf['Color'] = classify_layers(utm_gdf['Name'])
+    return utm_gdf, full_gdf
+
+@st.cache_data(max_entries=8, show_spinner="Membaca & memproyeksikan KML...")
+def load_uploaded_kml(file_id, _uploaded_file):
+    """load_and_project_kml untuk file upload Streamlit, di-cache per file_id.
+
+    Streamlit menjalankan ulang skrip pada setiap interaksi widget; dengan cache
+    ini KML hanya diparse & diproyeksikan sekali per upload.
+    """
+    # Salin bertahap per 1 MiB agar isi KML tidak digandakan di memori; folder sementara
+    # (beserta file KML) otomatis dihapus setelah dibaca
+    _uploaded_file.seek(0)
+    with tempfile.TemporaryDirectory() as tmpdir:
+        path = os.path.join(tmpdir, 'upload.kml')
+        with open(path, 'wb') as f:
+            shutil.copyfileobj(_uploaded_file, f, 1 << 20)
+        return load_and_project_kml(path)
+
+def split_coordinates(geoms):
+    """Mengambil koordinat semua geometri dalam satu panggilan lalu memecahnya per geometri.
+
+    Urutan hasil mengikuti `geoms` (geometri kosong menjadi array (0, 2)); input kosong -> [].
+    """
+    if len(geoms) == 0: return []
+    coords, idx = shapely.get_coordinates(geoms, return_index=True)
+    return np.split(coords, np.searchsorted(idx, np.arange(1, len(geoms))))
+
+@st.cache_data(ttl=86400, max_entries=32, show_spinner=False)
+def fetch_road_edges(lat, lon, crs, dist=1000):
+    """Mengambil ruas jalan OSM di sekitar titik pusat (dist 1km agar area luas tertangkap).
+
+    Ruas dikembalikan sudah diproyeksikan ke `crs` (CRS meter data KML). Hasil
+    di-cache per (lat, lon, crs, dist); bulatkan koordinat sebelum memanggil
+    agar upload di area yang sama memakai data yang sudah ada.
+    """
+    # osmnx (networkx, scipy) berat diimpor; baru dimuat saat DXF pertama dibuat
+    import osmnx as ox
+    # Respons Overpass disimpan di disk agar area yang sama tidak diunduh ulang
+    ox.settings.use_cache = True
+    ox.settings.cache_folder = '.osmcache'
+    streets = ox.graph_from_point((lat, lon), dist=dist, network_type='all', simplify=True)
+    # Hanya ruas yang dipakai; GeoDataFrame node (titik persimpangan) tidak dibangun
+    edges = ox.graph_to_gdfs(streets, nodes=False)
+    return edges.to_crs(crs)
 
-def generate_dxf_seamless(gdf_metric, original_gdf):
-    """Membuat DXF dengan metode Seamless Road (Tanpa Garis Putus)."""
+def generate_dxf_seamless(gdf_metric, center, simplify_tolerance=SIMPLIFY_TOLERANCE):
+    """Membuat DXF dengan metode Seamless Road (Tanpa Garis Putus), dikembalikan sebagai bytes.
+
+    Garis kabel disederhanakan (Douglas-Peucker) dengan `simplify_tolerance` meter;
+    label panjang tetap memakai Length_M dari geometri asli.
+    """
     doc = ezdxf.new('R2010')
     msp = doc.modelspace()
     
     # Setup Layers
-    doc.layers.new(name='MAP_ROAD_OUTLINE', dxfattribs={'color': 7}) # Putih
-    doc.layers.new(name='LABEL_INFO', dxfattribs={'color': 7})
-    doc.layers.new(name='CABLE_OFFSET', dxfattribs={'color': 1})    # Merah
+    for layer_name, color in DXF_LAYERS.items():
+        doc.layers.new(name=layer_name, dxfattribs={'color': color})
+
+    # --- A. UNDUH JALAN OSM DI LATAR BELAKANG ---
+    # Request Overpass berjalan di thread terpisah selama data KML disiapkan
+    avg_y, avg_x = center
+    executor = ThreadPoolExecutor(max_workers=1)
+    roads_future = executor.submit(fetch_road_edges, round(avg_y, 3), round(avg_x, 3), gdf_metric.crs.to_string())
+    executor.shutdown(wait=False)
+
+    # --- B. PERSIAPAN DATA KML (TIANG & KABEL) ---
+    # Pisahkan titik dan garis sekali saja, lalu ambil koordinat dalam bentuk array
+    type_ids = shapely.get_type_id(gdf_metric.geometry.values)
+    is_point, is_line = type_ids == POINT, type_ids == LINESTRING
+    names = gdf_metric['Name'].values
+    pts = gdf_metric[is_point]
+    pts_xy = shapely.get_coordinates(pts.geometry.values)
+    lines = gdf_metric[is_line]
+    line_geoms = lines.geometry.values
+    # Vertex GPS yang terlalu rapat dibuang agar DXF lebih kecil & cepat ditulis
+    if simplify_tolerance > 0:
+        line_geoms = shapely.simplify(line_geoms, simplify_tolerance, preserve_topology=False)
+    line_coords = split_coordinates(line_geoms)
+    # Garis offset kabel: buffer boundary kecil (lebih stabil dari parallel_offset) untuk
+    # semua garis dihitung dalam satu panggilan GEOS; cap flat & join mitre agar rapi kotak
+    offset_rings = shapely.boundary(shapely.buffer(line_geoms, 0.4, cap_style='flat', join_style='mitre'))
+    # Titik tengah tiap kabel (posisi label jarak) juga dihitung sekaligus
+    mids = shapely.line_interpolate_point(line_geoms, 0.5, normalized=True)
+    mid_xy = np.column_stack([shapely.get_x(mids), shapely.get_y(mids)])
+
+    # Layer hasil klasifikasi saat load; setiap layer CAD dibuat sekali sebelum menggambar
+    layer_names, colors = gdf_metric['Layer'].values, gdf_metric['Color'].values
+    used_layers, first_idx = np.unique(layer_names, return_index=True)
+    layer_colors = dict(zip(used_layers.tolist(), colors[first_idx].tolist()))
+    for layer_name, color in layer_colors.items():
+        doc.layers.new(name=layer_name, dxfattribs={'color': color})
 
-    # --- A. PROSES JALAN SEAMLESS (MENYAMBUNG TOTAL) ---
-    avg_y, avg_x = original_gdf.geometry.centroid.y.mean(), original_gdf.geometry.centroid.x.mean()
+    # dxfattribs dibuat sekali dan dipakai ulang oleh semua entitas (ezdxf tidak mengubahnya)
+    point_attribs = {ln: {'layer': ln} for ln in layer_colors}
+    line_attribs = {ln: {'layer': ln, 'color': color} for ln, color in layer_colors.items()}
+    name_label_attribs = {'layer': 'LABEL_INFO', 'height': 1.0}
+    length_label_attribs = {'layer': 'LABEL_INFO', 'height': 0.9}
+    offset_attribs = {'layer': 'CABLE_OFFSET'}
+
+    # --- C. PROSES JALAN SEAMLESS (MENYAMBUNG TOTAL) ---
     try:
         with st.spinner("Menyatukan jaringan jalan (Metode Seamless)..."):
-            # Ambil data jalan dari OSM (dist 1km agar area luas tertangkap)
-            streets = ox.graph_from_point((avg_y, avg_x), dist=1000, network_type='all', simplify=True)
-            _, edges = ox.graph_to_gdfs(streets)
-            edges_metric = edges.to_crs(gdf_metric.crs)
+            edges_metric = roads_future.result()
+            # Buang ruas di luar area KML (+ margin) sebelum union & buffer yang mahal
+            minx, miny, maxx, maxy = gdf_metric.total_bounds
+            pad = ROAD_CLIP_MARGIN
+            edges_metric = edges_metric.cx[minx - pad:maxx + pad, miny - pad:maxy + pad]
             
             # 1. Satukan semua garis jalan menjadi satu objek MultiLine (Merge Segments)
             all_lines = unary_union(edges_metric.geometry)
@@ -78,85 +227,79 @@ def generate_dxf_seamless(gdf_metric, original_gdf):
             # Boundary ini adalah garis luar yang mengelilingi seluruh jaringan jalan yang menyambung
             road_outline = road_polygon.boundary
             
-            # Tambahkan ke CAD
-            if isinstance(road_outline, (LineString, MultiLineString)):
-                if hasattr(road_outline, 'geoms'): # Jika MultiLineString
-                    for part in road_outline.geoms:
-                        msp.add_lwpolyline(list(part.coords), dxfattribs={'layer': 'MAP_ROAD_OUTLINE'})
-                else: # Jika LineString tunggal
-                    msp.add_lwpolyline(list(road_outline.coords), dxfattribs={'layer': 'MAP_ROAD_OUTLINE'})
+            # Tambahkan ke CAD (LineString tunggal maupun MultiLineString)
+            road_attribs = {'layer': 'MAP_ROAD_OUTLINE'}
+            for xy in split_coordinates(shapely.get_parts(road_outline)):
+                if len(xy): msp.add_lwpolyline(xy, format='xy', dxfattribs=road_attribs)
                     
     except Exception as e:
         st.sidebar.error(f"Error Pengolahan Jalan: {e}")
 
-    # --- B. DATA KML (TIANG & KABEL) ---
-    for _, row in gdf_metric.iterrows():
-        geom = row.geometry
-        name = str(row.get('Name', ''))
-        layer_name, color = get_layer_info(name)
-        
-        if layer_name not in doc.layers:
-            doc.layers.new(name=layer_name, dxfattribs={'color': color})
-
-        if geom.geom_type == 'Point':
-            # Gambar Lingkaran Tiang (TE)
-            msp.add_circle((geom.x, geom.y), radius=0.6, dxfattribs={'layer': layer_name})
-            # Label Nama Tiang
-            msp.add_text(name, dxfattribs={'layer': 'LABEL_INFO', 'height': 1.0}).set_placement((geom.x + 0.8, geom.y + 0.8))
-            
-        elif geom.geom_type == 'LineString':
-            # 1. Garis Utama Kabel (Hijau)
-            msp.add_lwpolyline(list(geom.coords), dxfattribs={'layer': layer_name, 'color': color})
-            
-            # 2. Garis Parallel Offset Kabel (Garis Merah di samping Hijau)
-            try:
-                # Gunakan buffer boundary kecil untuk offset yang lebih stabil
-                offset_c = geom.buffer(0.4, cap_style=2, join_style=2).boundary
-                if hasattr(offset_c, 'geoms'):
-                    for part in offset_c.geoms:
-                        msp.add_lwpolyline(list(part.coords), dxfattribs={'layer': 'CABLE_OFFSET'})
-                else:
-                    msp.add_lwpolyline(list(offset_c.coords), dxfattribs={'layer': 'CABLE_OFFSET'})
-            except: pass
-
-            # 3. Label Angka Jarak
-            mid = geom.interpolate(0.5, normalized=True)
-            if row['Length_M'] > 0:
-                msp.add_text(str(row['Length_M']), dxfattribs={'layer': 'LABEL_INFO', 'height': 0.9}).set_placement((mid.x + 0.5, mid.y + 0.5))
-
-    tmp_path = tempfile.mktemp(suffix='.dxf')
-    doc.saveas(tmp_path)
-    return tmp_path
+    # --- D. GAMBAR DATA KML ---
+    for (x, y), name, layer_name in zip(pts_xy, names[is_point], layer_names[is_point]):
+        # Gambar Lingkaran Tiang (TE)
+        msp.add_circle((x, y), radius=0.6, dxfattribs=point_attribs[layer_name])
+        # Label Nama Tiang
+        msp.add_text(name, dxfattribs=name_label_attribs).set_placement((x + 0.8, y + 0.8))
+
+    line_rows = zip(line_coords, offset_rings, mid_xy, layer_names[is_line], lines['Length_M'].values)
+    for xy, offset_c, (mid_x, mid_y), layer_name, length in line_rows:
+        # 1. Garis Utama Kabel (Hijau)
+        if len(xy): msp.add_lwpolyline(xy, format='xy', dxfattribs=line_attribs[layer_name])
+
+        # 2. Garis Parallel Offset Kabel (Garis Merah di samping Hijau)
+        for part in split_coordinates(shapely.get_parts(offset_c)):
+            if len(part): msp.add_lwpolyline(part, format='xy', dxfattribs=offset_attribs)
+
+        # 3. Label Angka Jarak
+        if length > 0:
+            msp.add_text(str(length), dxfattribs=length_label_attribs).set_placement((mid_x + 0.5, mid_y + 0.5))
+
+    # Tulis langsung ke memori; tombol download memakai bytes ini tanpa file sementara
+    stream = io.StringIO()
+    doc.write(stream)
+    return stream.getvalue().encode(doc.output_encoding)
 
 # --- 3. STREAMLIT INTERFACE ---
 st.title("📐 KML to DXF: Seamless Road & Cable Pro")
 st.markdown("Solusi perbaikan: Semua persimpangan jalan disatukan menggunakan **Geospatial Union** agar tidak ada garis putus-putus.")
 
 uploaded_file = st.sidebar.file_uploader("Upload KML File", type=['kml'])
+simplify_tolerance = st.sidebar.slider("Toleransi Penyederhanaan Kabel (m)", 0.0, 1.0, SIMPLIFY_TOLERANCE, 0.05,
+                                       help="Vertex kabel yang lebih rapat dari nilai ini dibuang; 0 = tanpa penyederhanaan")
 
 if uploaded_file:
-    with tempfile.NamedTemporaryFile(delete=False, suffix='.kml') as tmp:
-        tmp.write(uploaded_file.getvalue())
-        path = tmp.name
-
-    gdf_metric = load_and_project_kml(path)
+    gdf_metric, gdf_latlon = load_uploaded_kml(uploaded_file.file_id, uploaded_file)
     
     if gdf_metric is not None:
         st.sidebar.success(f"Berhasil memuat {len(gdf_metric)} objek.")
-        
+
+        # Titik pusat (lat, lon) dihitung sekali untuk query OSM dan peta preview
+        b = gdf_latlon.total_bounds
+        center = [(b[1] + b[3]) / 2, (b[0] + b[2]) / 2]
+
         if st.sidebar.button("🚀 Generate DXF Anti-Putus"):
             with st.spinner("Sedang menyambungkan jaringan jalan..."):
-                orig_latlon = gdf_metric.to_crs(epsg=4326)
-                dxf_file = generate_dxf_seamless(gdf_metric, orig_latlon)
-                with open(dxf_file, "rb") as f:
-                    st.sidebar.download_button("📥 Simpan File DXF", f, "Peta_Seamless_Pro.dxf")
+                # Disimpan di session_state agar tombol download tetap ada saat rerun
+                dxf_key = (uploaded_file.file_id, simplify_tolerance)
+                st.session_state.dxf_output = (dxf_key, generate_dxf_seamless(gdf_metric, center, simplify_tolerance))
+        dxf_output = st.session_state.get('dxf_output')
+        if dxf_output and dxf_output[0] == (uploaded_file.file_id, simplify_tolerance):
+            st.sidebar.download_button("📥 Simpan File DXF", dxf_output[1], "Peta_Seamless_Pro.dxf")
 
         # Map Preview
         st.subheader("Satellite Preview")
-        gdf_latlon = gdf_metric.to_crs(epsg=4326)
-        center = [gdf_latlon.geometry.centroid.y.mean(), gdf_latlon.geometry.centroid.x.mean()]
         m = folium.Map(location=center, zoom_start=18)
         folium.TileLayer('https://mt1.google.com/vt/lyrs=y&x={x}&y={y}&z={z}', attr='Google', name='Satellite').add_to(m)
+        # Objek KML dikirim sebagai dua layer GeoJSON (kabel & tiang), bukan satu layer Leaflet per objek
+        type_ids = shapely.get_type_id(gdf_latlon.geometry.values)
+        folium.GeoJson(gdf_latlon.geometry[type_ids == LINESTRING].to_json(), name='Kabel',
+                       style_function=lambda f: {'color': 'lime', 'weight': 3}).add_to(m)
+        points = gdf_latlon.geometry[type_ids == POINT]
+        if len(points) > PREVIEW_CLUSTER_MIN:
+            # Tiang sangat banyak: dikelompokkan di browser agar peta tetap ringan
+            FastMarkerCluster(shapely.get_coordinates(points.values)[:, ::-1].tolist(), name='Tiang').add_to(m)
+        else:
+            folium.GeoJson(points.to_json(), name='Tiang',
+                           marker=folium.CircleMarker(radius=4, color='red', fill=True)).add_to(m)
         folium_static(m, width=1000)
-    
-    os.unlink(path)